@@ -1,63 +1,536 @@
 #!/usr/bin/env python3
 
 import asyncio
+import cProfile
+import hashlib
+import io
+import itertools
 import json
 import logging
+import pstats
+import signal
+import time
 import configparser
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from types import MappingProxyType
 from websockets import connect
 from telegram import Bot
-from typing import Dict, Any
+from typing import Dict, Any, Mapping, Optional, Tuple, Union
 
 # 配置日志记录
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# 读取配置文件
-config = configparser.ConfigParser()
-config.read('.config')
+# 配置文件路径
+CONFIG_PATH = '.config'
 
-# Telegram 机器人 Token 和聊天 ID（建议使用环境变量或配置文件来存储这些信息）
-TELEGRAM_BOT_TOKEN = config['telegram']['bot_token']
-TELEGRAM_CHAT_ID = config['telegram']['chat_id']
+# 忽略的消息类型列表
+IGNORE_TYPES = ["heartbeat", "lifecycle"]
+
+# 关闭时等待发送队列清空的最长时间（秒）
+SHUTDOWN_DRAIN_TIMEOUT = 10
+
+# 调用 OneBot API 等待响应的最长时间（秒）
+API_TIMEOUT = 10
+
+# 合并转发最多展开的嵌套层数
+MAX_FORWARD_DEPTH = 3
+
+# 每个合并转发最多展开的节点数
+MAX_FORWARD_NODES = 100
+
+# 单条消息中所有合并转发最多展开的节点总数
+MAX_FORWARD_TOTAL_NODES = 500
+
+# 单条消息中合并转发展开后的最大字符数
+MAX_FORWARD_CHARS = 100000
+
+# 单条消息最多调用 get_forward_msg 的次数
+MAX_FORWARD_API_CALLS = 20
+
+# 缓存的合并转发数量
+FORWARD_CACHE_SIZE = 256
+
+# Telegram 单条消息的最大长度，超出时以文件发送
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+@dataclass(frozen=True)
+class RelayConfig:
+    """配置文件的不可变快照，热加载时整体替换"""
+    telegram_bot_token: str
+    telegram_chat_id: str
+    # OneBot WebSocket 服务器列表
+    ws_urls: Tuple[str, ...]
+    # OneBot 机器人名称列表
+    bot_names: Mapping[int, str]
+    # 表情ID到表情名称的映射字典
+    face_ids: Mapping[int, str]
+    # 去重时间窗口（秒）
+    dedup_window: int
+    # 每个时间窗口内最多记录的事件数
+    dedup_capacity: int
+    # 是否记录每条消息在各阶段的耗时
+    tracing_enabled: bool
+    # 定期输出各阶段耗时统计的间隔（秒）
+    tracing_report_interval: int
+    # 收到 SIGUSR2 后性能分析持续的时间（秒）
+    profile_seconds: int
+
+def load_config(path: str = CONFIG_PATH) -> RelayConfig:
+    """读取配置文件并生成配置快照"""
+    config = configparser.ConfigParser()
+    config.read(path)
+    ws_urls = (url.strip() for url in config['onebot']['ws_urls'].split(','))
+    positive_options = {
+        ('dedup', 'window'): 60,
+        ('dedup', 'capacity'): 100000,
+        ('tracing', 'report_interval'): 300,
+        ('tracing', 'profile_seconds'): 30,
+    }
+    values = {}
+    for (section, option), default in positive_options.items():
+        value = config.getint(section, option, fallback=default)
+        if value <= 0:
+            raise ValueError(f"[{section}] {option} 必须大于 0，当前为 {value}")
+        values[section, option] = value
+    return RelayConfig(
+        telegram_bot_token=config['telegram']['bot_token'],
+        telegram_chat_id=config['telegram']['chat_id'],
+        ws_urls=tuple(dict.fromkeys(url for url in ws_urls if url)),
+        bot_names=MappingProxyType({int(key): value for key, value in config['bot_names'].items()}),
+        face_ids=MappingProxyType({int(key): value for key, value in config['face_ids'].items()}),
+        dedup_window=values['dedup', 'window'],
+        dedup_capacity=values['dedup', 'capacity'],
+        tracing_enabled=config.getboolean('tracing', 'enabled', fallback=False),
+        tracing_report_interval=values['tracing', 'report_interval'],
+        profile_seconds=values['tracing', 'profile_seconds'],
+    )
+
+class EventDeduplicator:
+    """按时间窗口轮换的两代布隆过滤器，用于过滤多个后端重复上报的事件，内存占用固定"""
+
+    def __init__(self, window: float, capacity: int, hash_count: int = 10, inherited: Optional["EventDeduplicator"] = None):
+        self.window = window
+        self.capacity = capacity
+        self.hash_count = hash_count
+        # 误判率约 0.1% 时每个事件约需 15 位
+        self.bit_count = max(capacity * 15, 8)
+        self.current = bytearray((self.bit_count + 7) // 8)
+        self.previous = bytearray(len(self.current))
+        self.current_count = 0
+        self.rotated_at = time.monotonic()
+        # 热加载修改参数前的去重器，在其记录过期前继续参与查询
+        self.inherited = inherited
+        self.inherited_until = self.rotated_at + (2 * inherited.window if inherited else 0)
+
+    def _rotate(self, now: float):
+        """当前一代变为上一代，上一代清空后作为新的当前一代"""
+        self.previous, self.current = self.current, self.previous
+        self.current[:] = bytes(len(self.current))
+        self.current_count = 0
+        self.rotated_at = now
+
+    def _positions(self, key: bytes) -> list:
+        """用双重哈希计算事件在位图中的位置"""
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.bit_count for i in range(self.hash_count)]
+
+    @staticmethod
+    def _contains(bits: bytearray, positions: list) -> bool:
+        return all(bits[pos >> 3] & (1 << (pos & 7)) for pos in positions)
+
+    def contains(self, key: bytes) -> bool:
+        """只检查事件是否出现过，不做记录"""
+        positions = self._positions(key)
+        if self._contains(self.current, positions) or self._contains(self.previous, positions):
+            return True
+        # 连续多次热加载时，更早的去重器也可能仍未过期
+        return self.inherited is not None and time.monotonic() < self.inherited_until and self.inherited.contains(key)
+
+    def seen(self, key: bytes) -> bool:
+        """检查事件是否在时间窗口内出现过，未出现过则记录下来"""
+        now = time.monotonic()
+        if now - self.rotated_at >= 2 * self.window:
+            self._rotate(now)
+            self._rotate(now)
+        elif now - self.rotated_at >= self.window or self.current_count >= self.capacity:
+            self._rotate(now)
+
+        if self.inherited is not None:
+            if now >= self.inherited_until:
+                self.inherited = None
+            elif self.inherited.contains(key):
+                return True
+
+        positions = self._positions(key)
+        if self._contains(self.current, positions) or self._contains(self.previous, positions):
+            return True
+        for pos in positions:
+            self.current[pos >> 3] |= 1 << (pos & 7)
+        self.current_count += 1
+        return False
+
+def dedup_segment(element: Dict[str, Any]) -> Any:
+    """取出消息段中各后端一致的部分，无法确定时保留全部数据，宁可重复也不误删"""
+    element_type = element.get("type")
+    data = element.get("data", {})
+    if element_type == "text":
+        return data.get("text")
+    if element_type == "face":
+        return data.get("id")
+    if element_type == "at":
+        return data.get("qq")
+    if element_type == "reply":
+        # 被回复消息的 message_id 由各后端各自分配
+        return None
+    if element_type in ("image", "record", "video", "file"):
+        # 链接各不相同，文件名（通常含 md5）和大小在各后端一致
+        file_name = str(data.get("file", "")).split("?", 1)[0].rsplit("/", 1)[-1]
+        if file_name or data.get("file_size"):
+            return [file_name, data.get("file_size")]
+    return data
+
+def dedup_key(message: Dict[str, Any]) -> bytes:
+    """生成事件指纹，不同后端上报的同一事件指纹相同"""
+    if message.get("post_type") == "message":
+        content = [(element.get("type"), dedup_segment(element)) for element in message.get("message", [])]
+        if message.get("message_type") == "group":
+            fields = ["group", message.get("group_id"), message.get("user_id"), message.get("time"), content]
+        else:
+            # 私聊只在同一账号内去重
+            fields = ["private", message.get("self_id"), message.get("user_id"), message.get("time"), content]
+    else:
+        fields = ["event", {key: value for key, value in message.items() if key not in ("self_id", "selfid")}]
+    return json.dumps(fields, sort_keys=True, ensure_ascii=False, default=str).encode()
+
+@dataclass
+class ForwardBudget:
+    """单条消息展开合并转发的总预算，用完后不再展开"""
+    nodes: int = MAX_FORWARD_TOTAL_NODES
+    chars: int = MAX_FORWARD_CHARS
+    api_calls: int = MAX_FORWARD_API_CALLS
+    # 已处理过的合并转发 ID，同一条消息中重复出现的只获取一次
+    visited: set = field(default_factory=set)
+
+    def exhausted(self) -> bool:
+        return self.nodes <= 0 or self.chars <= 0
+
+class LatencyHistogram:
+    """按固定区间统计耗时分布的直方图"""
+
+    # 各区间的上界（毫秒），最后一个区间没有上界
+    BOUNDS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, milliseconds: float):
+        """记录一次耗时"""
+        index = 0
+        while index < len(self.BOUNDS) and milliseconds > self.BOUNDS[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += milliseconds
+        self.max = max(self.max, milliseconds)
+
+    def percentile(self, fraction: float) -> float:
+        """估算分位数，返回所在区间的上界，不超过实际最大值"""
+        target = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= target:
+                return min(self.BOUNDS[index], self.max) if index < len(self.BOUNDS) else self.max
+        return self.max
+
+    def summary(self) -> str:
+        """生成统计摘要"""
+        return (
+            f"次数 {self.count}，平均 {self.total / self.count:.1f}ms，"
+            f"p50 ≤{self.percentile(0.5):g}ms，p90 ≤{self.percentile(0.9):g}ms，"
+            f"p99 ≤{self.percentile(0.99):g}ms，最大 {self.max:.1f}ms"
+        )
+
+class EventTrace:
+    """记录一条消息依次经过各阶段的时间点"""
+
+    def __init__(self):
+        self.last = time.perf_counter()
+        self.started = self.last
+
+    def mark(self, stage: str):
+        """记录从上一个时间点到现在的耗时，计入该阶段的直方图"""
+        now = time.perf_counter()
+        stage_histograms.setdefault(stage, LatencyHistogram()).record((now - self.last) * 1000)
+        self.last = now
+
+    def finish(self):
+        """记录从接收到完成发送的总耗时"""
+        self.mark("ack")
+        stage_histograms.setdefault("total", LatencyHistogram()).record((self.last - self.started) * 1000)
+
+# 各阶段的耗时直方图，按阶段名索引，每次定期输出后清空
+stage_histograms: Dict[str, LatencyHistogram] = {}
+
+def report_latency(reset: bool = False):
+    """输出上次定期输出以来各阶段的耗时统计，reset 为真时输出后清空"""
+    if not stage_histograms:
+        logger.info("暂无耗时统计")
+        return
+    lines = [f"{stage}: {histogram.summary()}" for stage, histogram in stage_histograms.items()]
+    logger.info("上次定期输出以来各阶段耗时统计（每个阶段为距上一阶段的时间）:\n" + "\n".join(lines))
+    if reset:
+        stage_histograms.clear()
+
+# 正在进行的性能分析
+profiler: Optional[cProfile.Profile] = None
+
+def start_profiling():
+    """开始 cProfile 性能分析，到配置的时间后自动停止并保存结果"""
+    global profiler
+    if profiler is not None:
+        logger.warning("性能分析已在进行中")
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    asyncio.get_running_loop().call_later(CONFIG.profile_seconds, stop_profiling)
+    logger.info(f"开始性能分析，持续 {CONFIG.profile_seconds} 秒")
+
+def stop_profiling():
+    """停止性能分析，保存统计文件并在日志中输出耗时最多的函数"""
+    global profiler
+    if profiler is None:
+        return
+    profiler.disable()
+    path = f"profile-{time.strftime('%Y%m%d-%H%M%S')}.prof"
+    profiler.dump_stats(path)
+    stream = io.StringIO()
+    pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(20)
+    profiler = None
+    logger.info(f"性能分析结果已保存到 {path}\n{stream.getvalue()}")
+
+# 当前生效的配置，只通过 reload_config 整体替换
+CONFIG = load_config()
+
+# Telegram 机器人 Token（修改后需要重启才能生效）
+TELEGRAM_BOT_TOKEN = CONFIG.telegram_bot_token
 
 # 初始化 Telegram 机器人
 bot = Bot(token=TELEGRAM_BOT_TOKEN)
 
-# OneBot WebSocket 服务器列表
-ONEBOT_WS_URLS = config['onebot']['ws_urls'].split(',')
+# 每个 OneBot WebSocket 地址对应的连接任务
+ws_tasks: Dict[str, asyncio.Task] = {}
 
-# OneBot 机器人名称列表
-BOT_NAME = {int(key): value for key, value in config['bot_names'].items()}
+# 每个 OneBot WebSocket 地址当前的连接，用于调用 API
+ws_connections: Dict[str, Any] = {}
 
-# 忽略的消息类型列表
-IGNORE_TYPES = ["heartbeat", "lifecycle"]
+# 每个连接上等待响应的 API 调用，按 echo 索引
+pending_calls: Dict[str, Dict[str, asyncio.Future]] = {}
+
+# 正在获取合并转发的格式化任务，关闭时在断开连接前等待它们完成
+format_tasks: set = set()
+
+# 生成 API 调用的 echo
+echo_counter = itertools.count()
+
+# 已获取的合并转发内容，按转发 ID 缓存
+forward_cache: "OrderedDict[str, list]" = OrderedDict()
+
+# 事件去重器，参数修改后在热加载时重建并继承旧的记录
+deduplicator = EventDeduplicator(CONFIG.dedup_window, CONFIG.dedup_capacity)
+
+# 以下对象要绑定到 asyncio.run 启动的事件循环，由 create_runtime_state 在 main 中创建
 
-# 表情ID到表情名称的映射字典
-FACE_ID_TO_NAME = {int(key): value for key, value in config['face_ids'].items()}
+# 等待发送到 Telegram 的消息队列，元素为 (消息文本或正在获取合并转发的格式化任务, 耗时记录)
+delivery_queue: asyncio.Queue
+
+# 收到 SIGTERM/SIGINT 后置位，开始关闭流程
+shutdown_event: asyncio.Event
+
+# 关闭过程中再次收到信号后置位，不再等待发送队列
+force_exit_event: asyncio.Event
+
+def create_runtime_state():
+    """在当前事件循环中创建发送队列和关闭事件"""
+    global delivery_queue, shutdown_event, force_exit_event
+    delivery_queue = asyncio.Queue()
+    shutdown_event = asyncio.Event()
+    force_exit_event = asyncio.Event()
+
+def sync_ws_tasks(ws_urls: Tuple[str, ...]):
+    """按配置启动或停止 handle_onebot 任务，未变化的连接保持不动"""
+    for ws_url in list(ws_tasks):
+        if ws_url not in ws_urls:
+            ws_tasks.pop(ws_url).cancel()
+            logger.info(f"已停止 OneBot 连接: {ws_url}")
+    for ws_url in ws_urls:
+        if ws_url not in ws_tasks:
+            ws_tasks[ws_url] = asyncio.create_task(handle_onebot(ws_url))
+            logger.info(f"已启动 OneBot 连接: {ws_url}")
+
+def reload_config():
+    """重新读取配置文件，成功后替换配置快照并同步连接任务"""
+    global CONFIG, deduplicator
+    if shutdown_event.is_set():
+        return
+    try:
+        new_config = load_config()
+    except Exception as e:
+        logger.error(f"重新加载配置失败，继续使用旧配置: {e}")
+        return
+    if new_config.telegram_bot_token != TELEGRAM_BOT_TOKEN:
+        logger.warning("bot_token 已修改，需要重启后才能生效")
+    if (new_config.dedup_window, new_config.dedup_capacity) != (CONFIG.dedup_window, CONFIG.dedup_capacity):
+        # 旧的去重记录在过期前继续生效，避免切换时重复转发
+        deduplicator = EventDeduplicator(new_config.dedup_window, new_config.dedup_capacity, inherited=deduplicator)
+    CONFIG = new_config
+    sync_ws_tasks(new_config.ws_urls)
+    logger.info("配置已重新加载")
 
 async def handle_onebot(ws_url: str):
     """处理 OneBot WebSocket 连接并接收消息"""
     while True:
         try:
             async with connect(ws_url) as websocket:
-                async for message in websocket:
-                    data = json.loads(message)
-                    await process_onebot_message(data)
+                calls: Dict[str, asyncio.Future] = {}
+                ws_connections[ws_url] = websocket
+                pending_calls[ws_url] = calls
+                try:
+                    async for message in websocket:
+                        trace = EventTrace() if CONFIG.tracing_enabled else None
+                        data = json.loads(message)
+                        if "echo" in data:
+                            resolve_api_response(ws_url, data)
+                            continue
+                        if trace:
+                            trace.mark("decode")
+                        await process_onebot_message(data, ws_url, trace)
+                finally:
+                    # 同一地址被移除又重新加入时，新的连接可能已经登记，只清理自己的记录
+                    if ws_connections.get(ws_url) is websocket:
+                        ws_connections.pop(ws_url)
+                    if pending_calls.get(ws_url) is calls:
+                        pending_calls.pop(ws_url)
+                    for future in calls.values():
+                        if not future.done():
+                            future.set_exception(ConnectionError(f"与 {ws_url} 的连接已断开"))
         except Exception as e:
             logger.error(f"连接到 {ws_url} 失败: {e}")
             await asyncio.sleep(5)  # 等待 5 秒后重试
 
-async def process_onebot_message(message: Dict[str, Any]):
-    """处理收到的 OneBot 消息并转发到 Telegram"""
+def resolve_api_response(ws_url: str, response: Dict[str, Any]):
+    """将 API 响应交给等待它的调用"""
+    future = pending_calls.get(ws_url, {}).pop(str(response.get("echo")), None)
+    if future is not None and not future.done():
+        future.set_result(response)
+
+async def call_onebot_api(ws_url: str, action: str, params: dict) -> Any:
+    """通过已建立的 WebSocket 连接调用 OneBot API 并返回 data"""
+    websocket = ws_connections.get(ws_url)
+    if websocket is None:
+        raise ConnectionError(f"未连接到 {ws_url}")
+    calls = pending_calls[ws_url]
+    echo = str(next(echo_counter))
+    future = asyncio.get_running_loop().create_future()
+    calls[echo] = future
+    try:
+        await websocket.send(json.dumps({"action": action, "params": params, "echo": echo}))
+        response = await asyncio.wait_for(future, API_TIMEOUT)
+    finally:
+        calls.pop(echo, None)
+    if response.get("status") != "ok":
+        raise RuntimeError(f"{action} 调用失败: {response.get('wording') or response.get('message', '')}")
+    return response.get("data")
+
+async def process_onebot_message(message: Dict[str, Any], ws_url: str, trace: Optional[EventTrace] = None):
+    """处理收到的 OneBot 消息并放入发送队列"""
     if should_ignore_message(message):
         return
+    if deduplicator.seen(dedup_key(message)):
+        logger.info("忽略其他后端已上报过的重复事件")
+        return
+
+    if has_forward(message.get("message", [])):
+        # 获取合并转发的响应要经过同一个接收循环，因此放到单独的任务中，队列中的顺序不变
+        task = asyncio.create_task(format_message_with_forwards(message, ws_url, trace))
+        format_tasks.add(task)
+        task.add_done_callback(format_tasks.discard)
+        delivery_queue.put_nowait((task, trace))
+        # 含合并转发的消息先入队再格式化，各阶段单独统计，避免混入普通消息的直方图
+        if trace:
+            trace.mark("enqueue_forward")
+    else:
+        text = format_message(message)
+        if trace:
+            trace.mark("format")
+        delivery_queue.put_nowait((text, trace))
+        if trace:
+            trace.mark("enqueue")
 
+async def format_message_with_forwards(message: Dict[str, Any], ws_url: str, trace: Optional[EventTrace] = None) -> str:
+    """获取消息中的合并转发内容后再格式化"""
+    await fetch_forwards(message.get("message", []), ws_url, ForwardBudget())
+    if trace:
+        trace.mark("fetch_forward")
     text = format_message(message)
+    if trace:
+        trace.mark("format_forward")
+    return text
+
+async def send_to_telegram(text: str) -> bool:
+    """发送消息到 Telegram，过长的消息以文本文件发送，返回是否发送成功"""
+    chat_id = CONFIG.telegram_chat_id
     try:
-        await bot.send_message(chat_id=TELEGRAM_CHAT_ID, text=text, parse_mode='Markdown')
-        logger.info(f"消息已发送到 Telegram 聊天 ID {TELEGRAM_CHAT_ID}")
+        if len(text) > TELEGRAM_MESSAGE_LIMIT:
+            caption = text.split("\n", 1)[0][:200]
+            await bot.send_document(chat_id=chat_id, document=text.encode('utf-8'), filename="message.txt", caption=caption)
+        else:
+            await bot.send_message(chat_id=chat_id, text=text, parse_mode='Markdown')
+        logger.info(f"消息已发送到 Telegram 聊天 ID {chat_id}")
+        return True
     except Exception as e:
         logger.error(f"发送消息到 Telegram 失败: {e}")
+        return False
+
+def delivery_preview(item: Union[str, asyncio.Task]) -> str:
+    """发送队列元素的简短描述，用于日志"""
+    return item[:50] if isinstance(item, str) else "含合并转发的消息"
+
+async def initialize_bot():
+    """初始化 Telegram 机器人，连接失败时每 5 秒重试，期间消息留在发送队列中"""
+    while True:
+        try:
+            await bot.initialize()
+            return
+        except Exception as e:
+            logger.error(f"连接 Telegram 失败: {e}")
+            await asyncio.sleep(5)  # 等待 5 秒后重试
+
+async def telegram_sender():
+    """依次取出发送队列中的消息并发送到 Telegram"""
+    await initialize_bot()
+    while True:
+        item, trace = await delivery_queue.get()
+        try:
+            text = await item if isinstance(item, asyncio.Task) else item
+            if trace:
+                trace.mark("dequeue")
+            if await send_to_telegram(text) and trace:
+                trace.finish()
+        except asyncio.CancelledError:
+            logger.warning(f"发送被中断，消息可能未送达: {delivery_preview(item)}")
+            raise
+        except Exception as e:
+            logger.error(f"格式化消息失败: {e}")
+        finally:
+            delivery_queue.task_done()
 
 def should_ignore_message(message: Dict[str, Any]) -> bool:
     """检查消息是否应被忽略（如心跳消息）"""
@@ -89,7 +562,7 @@ def format_notice_message(message: Dict[str, Any]) -> str:
     group_id = message.get("groupid", "")
     operator_id = message.get("operatorid", "")
     
-    self_name = BOT_NAME[self_id]
+    self_name = CONFIG.bot_names[self_id]
     # 基础消息
     base_message = f"{self_name} 收到通知:\n"
     
@@ -159,7 +632,7 @@ def format_notice_message(message: Dict[str, Any]) -> str:
 def format_private_message(message: Dict[str, Any]) -> str:
     """格式化私聊消息"""
     self_id = message.get("self_id")
-    self_name = BOT_NAME[self_id]
+    self_name = CONFIG.bot_names[self_id]
     sender_info = message.get("sender", {})
     sender_id = sender_info.get("user_id", "未知")
     sender_nickname = sender_info.get("nickname", "未知")
@@ -173,7 +646,7 @@ def format_private_message(message: Dict[str, Any]) -> str:
 def format_group_message(message: Dict[str, Any]) -> str:
     """格式化群消息"""
     self_id = message.get("self_id")
-    self_name = BOT_NAME[self_id]
+    self_name = CONFIG.bot_names[self_id]
     sender_info = message.get("sender", {})
     sender_id = sender_info.get("user_id", "未知")
     sender_nickname = sender_info.get("nickname", "未知")
@@ -191,6 +664,13 @@ def format_message_content(raw_message: str, message_elements: list) -> str:
     # 初始化消息内容
 #   formatted_message = f"原始信息:\n{raw_message}\n"
     formatted_message = f"转换前信息:\n{message_elements}\n转换后后信息:\n"
+    return formatted_message + format_segments(message_elements)
+
+def format_segments(message_elements: list, depth: int = 0, budget: Optional[ForwardBudget] = None) -> str:
+    """逐个格式化消息段，合并转发中的消息段也通过这里递归处理"""
+    if budget is None:
+        budget = ForwardBudget()
+    formatted_message = ""
     # 处理消息段
     for element in message_elements:
         element_type = element.get("type")
@@ -202,7 +682,7 @@ def format_message_content(raw_message: str, message_elements: list) -> str:
             
         elif element_type == "face":
             face_id = data.get("id", "")
-            face_name = FACE_ID_TO_NAME.get(face_id, "未知表情")
+            face_name = CONFIG.face_ids.get(face_id, "未知表情")
             formatted_message += f"[表情 {face_id}: {face_name}]"
             
         elif element_type == "image":
@@ -295,25 +775,10 @@ def format_message_content(raw_message: str, message_elements: list) -> str:
             formatted_message += f"\n[回复消息{reply_id}: ]"
             
         elif element_type == "forward":
-            forward_id = data.get("id", "")
-            formatted_message += f"\n[合并转发: {forward_id}]"
+            formatted_message += format_forward(data, depth, budget)
             
         elif element_type == "node":
-            user_id = data.get("user_id", "")
-            nickname = data.get("nickname", "")
-            content = data.get("content", "")
-            formatted_message += f"\n[合并转发节点: {nickname} ({user_id})]"
-            if isinstance(content, list):
-                for sub_element in content:
-                    sub_element_type = sub_element.get("type")
-                    sub_data = sub_element.get("data", {})
-                    if sub_element_type == "text":
-                        sub_text_content = sub_data.get("text", "")
-                        formatted_message += sub_text_content
-                    elif sub_element_type == "face":
-                        sub_face_id = sub_data.get("id", "")
-                        formatted_message += f"[表情 {sub_face_id}]"
-                    # 可以继续添加更多子消息段处理
+            formatted_message += format_forward_node(element, depth, budget)
                         
         elif element_type == "xml":
             xml_data = data.get("data", "")
@@ -324,12 +789,201 @@ def format_message_content(raw_message: str, message_elements: list) -> str:
             formatted_message += f"\n[JSON消息: {json_data}]"
             
     return formatted_message
+
+def has_forward(message_elements: list) -> bool:
+    """检查消息段中是否有需要展开的合并转发"""
+    return isinstance(message_elements, list) and any(
+        element.get("type") in ("forward", "node") for element in message_elements
+    )
+
+def get_forward_nodes(data: Dict[str, Any]) -> Optional[list]:
+    """取出合并转发的节点列表，消息段自带内容时直接使用，否则查缓存"""
+    content = data.get("content")
+    if isinstance(content, list):
+        return content
+    return forward_cache.get(str(data.get("id", "")))
+
+async def fetch_forwards(message_elements: list, ws_url: str, budget: ForwardBudget, depth: int = 0):
+    """获取消息段中的合并转发内容并缓存，同一层的合并转发并发获取"""
+    if depth >= MAX_FORWARD_DEPTH or not isinstance(message_elements, list):
+        return
+    jobs = []
+    for element in message_elements:
+        element_type = element.get("type")
+        if element_type == "forward":
+            jobs.append(fetch_forward(element.get("data", {}), ws_url, budget, depth))
+        elif element_type == "node":
+            jobs.append(fetch_forwards(forward_node_fields(element)[2], ws_url, budget, depth + 1))
+    await asyncio.gather(*jobs)
+
+async def fetch_forward(data: Dict[str, Any], ws_url: str, budget: ForwardBudget, depth: int):
+    """通过 get_forward_msg 获取一个合并转发，嵌套的合并转发一并获取"""
+    forward_id = str(data.get("id", ""))
+    if forward_id:
+        if forward_id in budget.visited:
+            return
+        budget.visited.add(forward_id)
+    nodes = get_forward_nodes(data)
+    if nodes is None and forward_id:
+        if budget.api_calls <= 0:
+            return
+        budget.api_calls -= 1
+        try:
+            result = await call_onebot_api(ws_url, "get_forward_msg", {"message_id": forward_id, "id": forward_id})
+        except Exception as e:
+            logger.error(f"获取合并转发 {forward_id} 失败: {e}")
+            return
+        nodes = (result or {}).get("messages")
+        if not isinstance(nodes, list):
+            logger.error(f"获取合并转发 {forward_id} 失败: 返回的 messages 无效")
+            return
+        forward_cache[forward_id] = nodes
+        if len(forward_cache) > FORWARD_CACHE_SIZE:
+            forward_cache.popitem(last=False)
+    elif forward_id in forward_cache:
+        forward_cache.move_to_end(forward_id)
+    if not nodes:
+        return
+    count = max(min(len(nodes), MAX_FORWARD_NODES, budget.nodes), 0)
+    budget.nodes -= count
+    await asyncio.gather(*(
+        fetch_forwards(forward_node_fields(node)[2], ws_url, budget, depth + 1) for node in nodes[:count]
+    ))
+
+def forward_node_fields(node: Dict[str, Any]) -> Tuple[str, str, Union[list, str]]:
+    """取出合并转发节点的昵称、用户 ID 和内容，兼容消息段和消息两种格式"""
+    if node.get("type") == "node":
+        data = node.get("data", {})
+        return data.get("nickname", ""), data.get("user_id", ""), data.get("content", "")
+    sender = node.get("sender", {})
+    content = node.get("message", node.get("content", ""))
+    return sender.get("nickname", ""), sender.get("user_id", ""), content
+
+def format_forward(data: Dict[str, Any], depth: int, budget: ForwardBudget) -> str:
+    """格式化合并转发，已获取内容且预算未用完时递归展开各个节点"""
+    forward_id = data.get("id", "")
+    nodes = get_forward_nodes(data)
+    if nodes is None or depth >= MAX_FORWARD_DEPTH or budget.exhausted():
+        return f"\n[合并转发: {forward_id}]"
+    formatted_message = f"\n[合并转发: {forward_id}，共 {len(nodes)} 条]"
+    expanded = 0
+    for node in nodes[:MAX_FORWARD_NODES]:
+        if budget.exhausted():
+            break
+        formatted_message += format_forward_node(node, depth, budget)
+        expanded += 1
+    if len(nodes) > expanded:
+        formatted_message += f"\n[还有 {len(nodes) - expanded} 条未展开]"
+    return formatted_message + f"\n[合并转发 {forward_id} 结束]"
+
+def format_forward_node(node: Dict[str, Any], depth: int, budget: ForwardBudget) -> str:
+    """格式化合并转发中的一个节点，计入单条消息的预算"""
+    budget.nodes -= 1
+    nickname, user_id, content = forward_node_fields(node)
+    formatted_message = f"\n[合并转发节点: {nickname} ({user_id})]"
+    if isinstance(content, list):
+        formatted_message += format_segments(content, depth + 1, budget)
+    elif content:
+        formatted_message += str(content)
+    budget.chars -= len(formatted_message)
+    return formatted_message
     
 
+async def latency_reporter():
+    """开启耗时记录时定期输出统计"""
+    while True:
+        await asyncio.sleep(CONFIG.tracing_report_interval)
+        if CONFIG.tracing_enabled:
+            report_latency(reset=True)
+
+def request_shutdown():
+    """第一次收到信号时开始关闭，再次收到时不再等待发送队列"""
+    if shutdown_event.is_set():
+        logger.warning("再次收到关闭信号，放弃等待发送队列")
+        force_exit_event.set()
+    else:
+        shutdown_event.set()
+
+async def wait_for_drain(awaitable, timeout: float) -> bool:
+    """在期限内等待，超时或再次收到关闭信号时返回 False"""
+    task = asyncio.ensure_future(awaitable)
+    force_task = asyncio.create_task(force_exit_event.wait())
+    done, _ = await asyncio.wait({task, force_task}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+    task.cancel()
+    force_task.cancel()
+    return task in done
+
+async def shutdown(sender_task: asyncio.Task):
+    """停止接收新消息，在期限内发送完队列中的消息后关闭连接"""
+    logger.info("正在关闭")
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + SHUTDOWN_DRAIN_TIMEOUT
+
+    def remaining() -> float:
+        return max(deadline - loop.time(), 0)
+
+    # 获取合并转发要用到 OneBot 连接，先等这些任务完成再断开。
+    # 期间连接照常接收事件并放入发送队列，断开后的事件才不再接收，队列中的消息随后发送或列入未发送报告
+    while format_tasks and remaining() > 0:
+        logger.info(f"等待 {len(format_tasks)} 条含合并转发的消息完成格式化")
+        if not await wait_for_drain(asyncio.shield(asyncio.gather(*format_tasks, return_exceptions=True)), remaining()):
+            logger.warning("未能在断开连接前完成合并转发的获取")
+            break
+    logger.info("停止接收新的 OneBot 消息")
+    tasks = list(ws_tasks.values())
+    ws_tasks.clear()
+    for task in tasks:
+        task.cancel()
+    # 等待连接任务退出，WebSocket 随之关闭，同样受关闭期限约束
+    if tasks:
+        await asyncio.wait(tasks, timeout=remaining())
+
+    logger.info(f"等待发送队列中的 {delivery_queue.qsize()} 条消息，最多 {remaining():.0f} 秒")
+    if not await wait_for_drain(delivery_queue.join(), remaining()) and not delivery_queue.empty():
+        logger.warning("未能在关闭前发送完队列中的消息")
+    sender_task.cancel()
+    await asyncio.gather(sender_task, return_exceptions=True)
+
+    undelivered = []
+    while not delivery_queue.empty():
+        item, _ = delivery_queue.get_nowait()
+        if isinstance(item, asyncio.Task):
+            item.cancel()
+        undelivered.append(item)
+    if undelivered:
+        logger.warning(f"关闭时有 {len(undelivered)} 条消息未发送:")
+        for item in undelivered:
+            logger.warning(f"未发送: {delivery_preview(item)}")
+    else:
+        logger.info("发送队列已清空")
+    stop_profiling()
+    if stage_histograms:
+        report_latency()
+
 async def main():
     """主函数，创建任务并启动处理"""
-    tasks = [asyncio.create_task(handle_onebot(ws_url)) for ws_url in ONEBOT_WS_URLS]
-    await asyncio.gather(*tasks)
+    create_runtime_state()
+    loop = asyncio.get_running_loop()
+    # 收到 SIGHUP 时热加载配置，已有连接不受影响
+    loop.add_signal_handler(signal.SIGHUP, reload_config)
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, request_shutdown)
+    # 收到 SIGUSR1 时输出耗时统计，收到 SIGUSR2 时开始性能分析
+    loop.add_signal_handler(signal.SIGUSR1, report_latency)
+    loop.add_signal_handler(signal.SIGUSR2, start_profiling)
+
+    sender_task = asyncio.create_task(telegram_sender())
+    reporter_task = asyncio.create_task(latency_reporter())
+    sync_ws_tasks(CONFIG.ws_urls)
+    try:
+        # 连接任务会随配置增减，因此这里等待关闭信号而不是 gather 固定的任务列表
+        await shutdown_event.wait()
+        reporter_task.cancel()
+        await shutdown(sender_task)
+    finally:
+        # 关闭 Telegram 的 HTTP 连接池
+        await bot.shutdown()
+    logger.info("已关闭")
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -387,9 +387,13 @@ async def start(update: Update, context: CallbackContext):
                                    "`/get_status <backend>` 获取运行状态\n"
                                    "`/get_version_info <backend>` 获取版本信息")
 
+async def post_shutdown(application: Application):
+    """机器人关闭后记录日志"""
+    logger.info("已处理完所有待处理的更新，Telegram 连接已关闭")
+
 def main():
     """主函数，设置 Telegram 机器人并开始监听消息"""
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    application = Application.builder().token(TELEGRAM_BOT_TOKEN).post_shutdown(post_shutdown).build()
     
     # 添加处理消息的处理器
     application.add_handler(CommandHandler('send', send))
@@ -411,9 +415,9 @@ def main():
     application.add_handler(CommandHandler('get_version_info', get_version_info))
     application.add_handler(CommandHandler('start', start))
     
-    # 启动 Telegram 机器人
+    # 启动 Telegram 机器人，默认收到 SIGINT/SIGTERM/SIGABRT 后会先处理完已收到的更新再退出
     application.run_polling()
     
 if __name__ == "__main__":
-    asyncio.run(main())
+    main()
     
\ No newline at end of file